@@ -6,12 +6,20 @@ Author: Sunil Chauhan
 The functions in this module facilitate to accept Orders for limit order processing.
 
 Usage:
-    from limit_order_agent import LimitOrderAgent, Order
+    from limit.limit_order_agent import LimitOrderAgent, Order
     from trading_framework.execution_client import ExecutionClient
     
     order = Order('buy', '123', 1000, 100.0)
     limit_order_obj = LimitOrderAgent(ExecutionClient())
     limit_order_obj.add_order(order)
+    limit_order_obj.on_price_tick('123', 99.5)  # market data pushed by price feed
+
+    Price feeds of many products can be multiplexed on an asyncio event loop without the simulation thread:
+    limit_order_obj = LimitOrderAgent(ExecutionClient(), simulate_prices=False)
+    loop.call_soon_threadsafe(limit_order_obj.on_price_tick, '123', 99.5)  # or called directly from a coroutine
+
+    Order processing progress is logged at DEBUG level to 'limit.limit_order_agent' logger, e.g.
+    logging.basicConfig(level=logging.DEBUG)
     
 Current flaws (limitations) of the trading framework:
 1. ExecutionClient Protocol class through 'buy' and 'sell' abstract methods implements interface
@@ -32,22 +40,35 @@ Current flaws (limitations) of the trading framework:
    improves re-usability of LimitOrderAgent class to work with different broker PriceListners using on_price_tick()
    method
 7. No return type defined for on_price_tick() of PriceListener Protocol
-8. No broker APIs provided for on_price_tick() implementation, hence 'random' module is used to simulate
-   real-time ticker pricing.
+8. No broker APIs provided to feed on_price_tick(), hence random numbers (numpy generator when available,
+   'random' module otherwise) are used by simulate_price() to simulate real-time ticker pricing.
 9. Typo in docstring for on_price_tick() method in PriceListener Protocol class for 'price' argument 
    (Should be 'the' in place of 'hte')
 """
 
+import heapq
+import logging
 import threading
-import time
 import random
+from collections import defaultdict, deque
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple, Type
+
+try:
+    import numpy as np
+except ImportError:
+    # numpy is optional, simulated prices fall back to random module
+    np = None
 
 from trading_framework.execution_client import ExecutionClient, ExecutionException
-from trading_framework.price_listener import PriceListener
+
+logger = logging.getLogger(__name__)
 
 class Order:
     """Responsible for creating Order object
     """
+    # Fixed attributes, no per instance __dict__
+    __slots__ = ('order_type', 'product_id', 'quantity', 'limit_price', 'sign', 'pooled', '_exec')
+
     def __init__(self, flag: str, product_id: str, quantity: int, limit_price: float) -> None:
         """Constructor to initialise Order object
 
@@ -61,72 +82,311 @@ class Order:
         self.product_id = product_id
         self.quantity = quantity
         self.limit_price = limit_price
+        # +1 for buy and -1 for sell, order is matched when sign * (limit_price - current_price) >= 0
+        self.sign = 1 if self.order_type == 'buy' else -1
+        # Only orders acquired from OrderPool are released back after execution
+        self.pooled = False
+        # ExecutionClient buy or sell method, bound by LimitOrderAgent when order is added
+        self._exec = None
+
+class OrderPool:
+    """Responsible for recycling Order objects, so held orders do not allocate a new object on every add
+    """
+    __slots__ = ('_free',)
+
+    def __init__(self, size: int = 1024) -> None:
+        """Constructor to preallocate blank Order objects
+
+        Args:
+            size (int): number of Order objects to preallocate, pool never keeps more free objects than this
+        """
+        # Fixed capacity: releasing into a full pool drops the oldest free object, so memory stays bounded
+        # after a burst of orders allocated beyond the preallocated size
+        self._free = deque((Order.__new__(Order) for _ in range(size)), maxlen=size)
+
+    def acquire(self, flag: str, product_id: str, quantity: int, limit_price: float) -> Order:
+        """Fetch Order object from pool (or allocate one if pool is exhausted) and set its fields
+
+        Args:
+            flag (str): flag indicating whether to buy or sell (i.e. Order type)
+            product_id (str): product id of the stock
+            quantity (int): quantity to buy/sell
+            limit_price (float): the limit at which to buy or sell
+
+        Returns:
+            order (Order): Order object owned by the pool
+        """
+        # Pool is shared between threads, so pop is attempted rather than checking emptiness first
+        try:
+            order = self._free.pop()
+        except IndexError:
+            order = Order.__new__(Order)
+        order.order_type = flag.lower()
+        order.product_id = product_id
+        order.quantity = quantity
+        order.limit_price = limit_price
+        order.sign = 1 if order.order_type == 'buy' else -1
+        order.pooled = True
+        order._exec = None
+        return order
+
+    def release(self, order: Order) -> None:
+        """Return Order object to pool for reuse (dropped if pool is full)
+
+        Args:
+            order (Order): Order object acquired from the pool
+        """
+        self._free.append(order)
+
+    def __len__(self) -> int:
+        return len(self._free)
 
-class LimitOrderAgent(PriceListener):
+# Pool shared by all LimitOrderAgent objects
+GLOBAL_ORDER_POOL = OrderPool()
+
+class LimitOrderAgent:
     """Responsible for processing orders based on given limit price. Uses multi-threading to add and process new orders.
+    Satisfies PriceListener protocol structurally through on_price_tick() instead of inheriting from it (see flaw 5 in module docstring).
     """
 
-    def __init__(self, execution_client: ExecutionClient) -> None:
+    # Number of simulated prices generated in one batch
+    price_buffer_size = 65536
+    # Subclasses created by specialize_for() keyed by (base class, product id)
+    _specialized: Dict[Tuple[type, str], type] = {}
+
+    def __init__(self, execution_client: ExecutionClient, order_pool: OrderPool = GLOBAL_ORDER_POOL,
+                 tick_interval: float = 1.0, simulate_prices: bool = True,
+                 price_source: Optional[Callable[[str], float]] = None) -> None:
         """ Initialise Limit Order Agent class
         
         Args:
             execution_client: can be used to buy or sell - see ExecutionClient protocol definition
+            order_pool (OrderPool): pool used by place_order to recycle Order objects
+            tick_interval (float): seconds between simulated price ticks for held orders
+            simulate_prices (bool): start thread ticking held orders with simulated prices. Set to False when
+                prices are pushed through on_price_tick() by a price feed (e.g. asyncio event loop), no thread
+                is started then and new orders are held on next price tick.
+            price_source (callable): returns current price for given product id to the simulation thread,
+                defaults to simulate_price()
         """
-        super().__init__()
         self.execution_client = execution_client
-        self.order_queue = []
-        self.lock = threading.Lock()
+        self.order_pool = order_pool
+        # Order book per product id: heap of price levels for each side (bids negated to get a max-heap) and
+        # FIFO queue of orders for each (product_id, order_type, limit_price) level for time priority
+        self.bids: Dict[str, List[float]] = defaultdict(list)
+        self.asks: Dict[str, List[float]] = defaultdict(list)
+        self.price_to_queue: Dict[Tuple[str, str, float], Deque[Order]] = {}
+        # Product ids with at least one held order, ticked in turn by queue processing thread
+        self._active_products: Set[str] = set()
+        self.tick_interval = tick_interval
+        # Simulated prices are generated in batches and served from buffer (filled on first tick)
+        self._rng = np.random.default_rng() if np is not None else None
+        self._price_buf: List[float] = []
+        self._price_idx = 0
+        self.price_source = price_source if price_source is not None else self.simulate_price
+        # New orders are handed over to the processing thread through pending queue guarded by condition variable
+        self._pending: Deque[Order] = deque()
+        self._cv = threading.Condition()
         self._stop_thread_event = threading.Event()
-        # Thread responsible for running infinite loop and processing new order once available in queue
-        self._thread = threading.Thread(target=self._process_queue, args=(self._stop_thread_event,))
-        self._thread.daemon = True
-        self._thread.start()
+        self._thread: Optional[threading.Thread] = None
+        if simulate_prices:
+            # Thread responsible for running infinite loop and processing new order once available in queue
+            self._thread = threading.Thread(target=self._process_queue, args=(self._stop_thread_event,))
+            self._thread.daemon = True
+            self._thread.start()
     
     def add_order(self, order: Order) -> None:
-        """Append new Order object to order queue
+        """Append new Order object to pending queue and wake up queue processing thread
         
         Args:
             order (Order):  New order to add in queue
+
+        Raises:
+            ValueError: if order type is neither 'buy' nor 'sell'
+        """
+        if order.order_type not in ('buy', 'sell'):
+            raise ValueError(f"Invalid order type: {order.order_type}")
+        order._exec = self.execution_client.buy if order.sign > 0 else self.execution_client.sell
+        with self._cv:
+            self._pending.append(order)
+            self._cv.notify()
+
+    def _hold_order(self, order: Order) -> None:
+        """Add Order object to order book of its product. Caller must hold the condition variable.
+
+        Args:
+            order (Order): order to hold until executed
+        """
+        key = (order.product_id, order.order_type, order.limit_price)
+        level = self.price_to_queue.get(key)
+        if level is None:
+            # New price level, push its price once on the heap of respective side
+            level = self.price_to_queue[key] = deque()
+            if order.sign > 0:
+                heapq.heappush(self.bids[order.product_id], -order.limit_price)
+            else:
+                heapq.heappush(self.asks[order.product_id], order.limit_price)
+        level.append(order)
+        self._active_products.add(order.product_id)
+
+    def _drain_pending(self) -> None:
+        """Move pending orders to order book. Caller must hold the condition variable.
+        """
+        while self._pending:
+            self._hold_order(self._pending.popleft())
+
+    def place_order(self, flag: str, product_id: str, quantity: int, limit_price: float) -> None:
+        """Add new order using Order object from order pool. Order object is released to the pool once executed,
+        hence it is not returned to the caller.
+
+        Args:
+            flag (str): flag indicating whether to buy or sell (i.e. Order type)
+            product_id (str): product id of the stock
+            quantity (int): quantity to buy/sell
+            limit_price (float): the limit at which to buy or sell
         """
-        with self.lock:
-            self.order_queue.append(order)  
+        order = self.order_pool.acquire(flag, product_id, quantity, limit_price)
+        try:
+            self.add_order(order)
+        except ValueError:
+            self.order_pool.release(order)
+            raise
 
-    def on_price_tick(self, product_id: str, price: float) -> float:
-        """Fetch current price for given product id using broker API
+    def best_order(self, product_id: str, order_type: str) -> Optional[Order]:
+        """Peek order with highest priority (best price, then earliest) for given product and order type.
+        Orders added before the call are included, even if not yet picked up by a price tick.
 
         Args:
             product_id (str): product id of the stock
-            price (float): Limit price of the stock
+            order_type (str): 'buy' or 'sell'
 
         Returns:
-            current_price (float): Current price of the stock
+            order (Order): best order or None if there is no held order. Order added through place_order() is
+                released to the order pool once executed and reused for a later order, so it is valid only
+                until the next price tick of its product.
         """
-        # See PriceListener protocol and readme file
-        # Simulate current price using random.uniform() for price between 1.0 to 200.0 for given product id
-        current_price = random.uniform(1.0, 200.0)
-        print(f"Current price of {product_id} is {current_price}")
-        return current_price
+        with self._cv:
+            self._drain_pending()
+            heap = self.bids.get(product_id) if order_type == 'buy' else self.asks.get(product_id)
+            if not heap:
+                return None
+            price = -heap[0] if order_type == 'buy' else heap[0]
+            return self.price_to_queue[(product_id, order_type, price)][0]
+
+    def held_products(self) -> List[str]:
+        """Product ids having at least one held order, including orders not yet picked up by a price tick
+
+        Returns:
+            product_ids (list): product ids with held orders
+        """
+        with self._cv:
+            self._drain_pending()
+            return list(self._active_products)
+
+    def on_price_tick(self, product_id: str, price: float) -> None:
+        """Execute all held orders of given product id whose limit price is matched by the current market price.
+        Can be invoked by a price feed from any thread.
+
+        Args:
+            product_id (str): product id of the stock
+            price (float): current market price of the stock
+        """
+        with self._cv:
+            self._drain_pending()
+            if product_id in self._active_products:
+                self._match(product_id, price, self.bids[product_id], self.asks[product_id])
+
+    def _match(self, product_id: str, price: float, bids: List[float], asks: List[float]) -> None:
+        """Execute matched price levels of given product. Caller must hold the condition variable.
+
+        Args:
+            product_id (str): product id of the stock
+            price (float): current market price of the stock
+            bids (list): heap of negated buy limit prices of the product
+            asks (list): heap of sell limit prices of the product
+
+        Raises:
+            ExecutionException: if execution of an order failed on either side
+        """
+        price_to_queue = self.price_to_queue
+        execute_level = self._execute_level
+        error = None
+        try:
+            for order_type, sign, heap in (('buy', 1, bids), ('sell', -1, asks)):
+                # Orders of a price level share the limit price, so limit is checked once per level and
+                # whole level is executed, best level first, until first unmatched level
+                try:
+                    while heap:
+                        limit_price = -heap[0] if sign > 0 else heap[0]
+                        if sign * (limit_price - price) < 0:
+                            break
+                        key = (product_id, order_type, limit_price)
+                        execute_level(price_to_queue[key], price)
+                        del price_to_queue[key]
+                        heapq.heappop(heap)
+                except ExecutionException as e:
+                    # Failed order stays held, the other side is still matched before error is raised
+                    if error is None:
+                        error = e
+            if error is not None:
+                raise error
+        finally:
+            if not bids and not asks:
+                self._active_products.discard(product_id)
 
-    def execute_orders(self, order: Order, current_price: float) -> None:
-        """Execute limit order if limit price matched with current price
+    def _execute_level(self, level: Deque[Order], current_price: float) -> None:
+        """Execute all orders of a matched price level in time priority. Order is removed from the level only
+        once executed, so orders left after a failed execution are still held.
 
         Args:
-            order (Order):  New order for processing
+            level (deque): orders held at a price level matched by current price
             current_price (float): Current price of the stock
+
+        Raises:
+            ExecutionException: if execution of an order failed
         """
+        release = self.order_pool.release
+        debug = logger.isEnabledFor(logging.DEBUG)
         try:
-            if (order.order_type == 'buy' and order.limit_price >= current_price):
-                print(f"Executing {order.order_type} order for {order.quantity} at {current_price} for limit price {order.limit_price}")
-                self.execution_client.buy(order.product_id, order.quantity)
-                self.order_queue.pop(0)
-            elif (order.order_type == 'sell' and order.limit_price <= current_price):
-                print(f"Executing {order.order_type} order for {order.quantity} at {current_price} for limit price {order.limit_price}")
-                self.execution_client.sell(order.product_id, order.quantity)
-                self.order_queue.pop(0)
-            else:
-                print(f"Limit price not matched with current price for {order.product_id}.")
+            while level:
+                order = level[0]
+                if debug:
+                    logger.debug("Executing %s order for %s at %s for limit price %s",
+                                 order.order_type, order.quantity, current_price, order.limit_price)
+                order._exec(order.product_id, order.quantity)
+                level.popleft()
+                if order.pooled:
+                    release(order)
         except Exception as e:
-            raise ExecutionException(f"Error during executing orders")
+            raise ExecutionException("Error during executing orders") from e
+
+    def simulate_price(self, product_id: str) -> float:
+        """Fetch current price for given product id. No broker API available, hence price is simulated.
+
+        Args:
+            product_id (str): product id of the stock
+
+        Returns:
+            current_price (float): Current price of the stock
+        """
+        # See PriceListener protocol and readme file
+        # Simulate current price between 1.0 to 200.0 for given product id from batch of random prices
+        if self._price_idx >= len(self._price_buf):
+            self._refill_price_buffer()
+        current_price = self._price_buf[self._price_idx]
+        self._price_idx += 1
+        logger.debug("Current price of %s is %s", product_id, current_price)
+        return current_price
+
+    def _refill_price_buffer(self) -> None:
+        """Generate next batch of simulated prices between 1.0 to 200.0
+        """
+        if self._rng is not None:
+            self._price_buf = self._rng.uniform(1.0, 200.0, self.price_buffer_size).tolist()
+        else:
+            uniform = random.uniform
+            self._price_buf = [uniform(1.0, 200.0) for _ in range(self.price_buffer_size)]
+        self._price_idx = 0
 
     def _process_queue(self, event_object) -> None:
         """Process limit order queue
@@ -134,19 +394,110 @@ class LimitOrderAgent(PriceListener):
         Args:
             event_object (threading.Event): Event object to stop/start thread responsible for Queue processing
         """
-        while not event_object.is_set():
-            with self.lock:
-                if self.order_queue:
-                    print(f"Total held orders waiting for execution: {len(self.order_queue)}")
-                    order = self.order_queue[0]
-                    print(f"Currently executing order: {order.product_id}")
-                    current_price = self.on_price_tick(order.product_id, order.limit_price)
-                    self.execute_orders(order, current_price)
-                    time.sleep(1)
+        # Bind attributes used on every iteration to locals
+        cv = self._cv
+        pending = self._pending
+        price_to_queue = self.price_to_queue
+        drain_pending = self._drain_pending
+        active_products = self._active_products
+        price_source = self.price_source
+        on_tick = self.on_price_tick
+        is_stopped = event_object.is_set
+        has_work = lambda: pending or is_stopped()
+        while not is_stopped():
+            with cv:
+                # Sleep until new order arrives or stop is requested; held orders are re-priced every tick interval
+                cv.wait_for(has_work, timeout=self.tick_interval if price_to_queue else None)
+                if is_stopped():
+                    break
+                drain_pending()
+                if active_products:
+                    debug = logger.isEnabledFor(logging.DEBUG)
+                    if debug:
+                        logger.debug("Total held price levels waiting for execution: %d", len(price_to_queue))
+                    # Every product with held orders gets a tick, so an unmatched product never blocks the others
+                    for product_id in list(active_products):
+                        if debug:
+                            logger.debug("Currently executing orders: %s", product_id)
+                        try:
+                            on_tick(product_id, price_source(product_id))
+                        except ExecutionException:
+                            # Failed order is still held and retried on next tick, other products carry on
+                            logger.exception("Error during executing orders of %s", product_id)
     
+    @classmethod
+    def specialize_for(cls, product_id: str) -> Type['LimitOrderAgent']:
+        """Create (or fetch cached) subclass handling orders of a single product id only. Order book heaps of
+        the product are bound to the agent object, so price ticks of an actively traded product skip the
+        per product lookups.
+
+        Usage:
+            agent = LimitOrderAgent.specialize_for('IBM')(ExecutionClient())
+
+        Args:
+            product_id (str): product id of the stock
+
+        Returns:
+            specialized_class (type): LimitOrderAgent subclass for given product id
+        """
+        specialized = cls._specialized.get((cls, product_id))
+        if specialized is not None:
+            return specialized
+
+        def __init__(self, *args, **kwargs) -> None:
+            """Initialise agent and bind order book heaps of the product
+
+            Args:
+                *args, **kwargs: arguments of LimitOrderAgent constructor
+            """
+            cls.__init__(self, *args, **kwargs)
+            self._product_bids = self.bids[product_id]
+            self._product_asks = self.asks[product_id]
+
+        def add_order(self, order: Order) -> None:
+            """Append new Order object of the product to pending queue
+
+            Args:
+                order (Order): New order to add in queue
+
+            Raises:
+                ValueError: if order is of another product or its type is neither 'buy' nor 'sell'
+            """
+            if order.product_id != product_id:
+                raise ValueError(f"Agent accepts orders of product {product_id} only, got {order.product_id}")
+            cls.add_order(self, order)
+
+        def on_price_tick(self, tick_product_id: str, price: float) -> None:
+            """Execute all held orders whose limit price is matched by the current market price. Ticks of
+            other products are ignored.
+
+            Args:
+                tick_product_id (str): product id of the stock
+                price (float): current market price of the stock
+            """
+            if tick_product_id != product_id:
+                return
+            with self._cv:
+                self._drain_pending()
+                if self._product_bids or self._product_asks:
+                    self._match(product_id, price, self._product_bids, self._product_asks)
+
+        specialized = type(f"{cls.__name__}[{product_id}]", (cls,), {
+            '__doc__': f"{cls.__name__} specialized for orders of product {product_id}",
+            'product_id': product_id,
+            '__init__': __init__,
+            'add_order': add_order,
+            'on_price_tick': on_price_tick,
+        })
+        cls._specialized[(cls, product_id)] = specialized
+        return specialized
+
     def stop_processing_queue(self) -> None:
         """Stop thread responsible for queue processing
         """
-        self._stop_thread_event.set()
-        self._thread.join()
+        with self._cv:
+            self._stop_thread_event.set()
+            self._cv.notify()
+        if self._thread is not None:
+            self._thread.join()
     
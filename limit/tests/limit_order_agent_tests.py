@@ -2,14 +2,20 @@
 
 Test classes:
 - OrderTest: Test case for Order class
+- OrderPoolTest: Test case for OrderPool class
 - LimitOrderAgentTest: Test case for LimitOrderAgent class
+- PriceFeedTest: Test case for LimitOrderAgent class without simulated prices
+- SpecializedLimitOrderAgentTest: Test case for LimitOrderAgent.specialize_for subclasses
+- PriceSimulationTest: Test case for simulated prices of LimitOrderAgent class
 """
+import asyncio
+import threading
+import time
 import unittest
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock
 
-from trading_framework.execution_client import ExecutionClient
-from limit_order_agent import LimitOrderAgent, Order, random
-from limit.limit_order_agent import Order
+from trading_framework.execution_client import ExecutionClient, ExecutionException
+from limit.limit_order_agent import LimitOrderAgent, Order, OrderPool
 
 class OrderTest(unittest.TestCase):
     """Test Order class
@@ -22,64 +28,385 @@ class OrderTest(unittest.TestCase):
         self.assertEqual(order.order_type, 'buy')
         self.assertEqual(order.limit_price, 100.0)
         self.assertEqual(order.quantity, 500)
+        self.assertEqual(order.sign, 1)
+        self.assertFalse(order.pooled)
+        self.assertEqual(Order('Sell', '123', 500, 100.0).sign, -1)
+
+    def test_slots(self):
+        """Test Order object does not accept undeclared attributes
+        """
+        order = Order('buy', '123', 500, 100.0)
+        with self.assertRaises(AttributeError):
+            order.price = 100.0
+
+class OrderPoolTest(unittest.TestCase):
+    """Test OrderPool class
+    """
+    def test_acquire_release(self):
+        """Test Order object is reused after release
+        """
+        pool = OrderPool(size=1)
+        order = pool.acquire('Sell', '123', 500, 100.0)
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(order.order_type, 'sell')
+        self.assertEqual(order.sign, -1)
+        self.assertEqual(order.product_id, '123')
+        self.assertEqual(order.quantity, 500)
+        self.assertEqual(order.limit_price, 100.0)
+        self.assertTrue(order.pooled)
+        pool.release(order)
+        self.assertIs(pool.acquire('buy', '456', 10, 1.0), order)
+        self.assertEqual(order.order_type, 'buy')
+
+    def test_release_full(self):
+        """Test pool does not grow beyond its size
+        """
+        pool = OrderPool(size=2)
+        orders = [pool.acquire('buy', '123', 500, 100.0) for _ in range(4)]
+        for order in orders:
+            pool.release(order)
+        self.assertEqual(len(pool), 2)
+
+    def test_acquire_exhausted(self):
+        """Test pool allocates new Order object once exhausted
+        """
+        pool = OrderPool(size=0)
+        order = pool.acquire('buy', '123', 500, 100.0)
+        self.assertEqual(order.product_id, '123')
 
 class LimitOrderAgentTest(unittest.TestCase):
     """Test to unittest functionality of limit_order_agent class
     """
     def setUp(self):
         self.mock_execution_client = MagicMock(spec=ExecutionClient)
-        self.limit_order_agent = LimitOrderAgent(self.mock_execution_client)
-        self.mock_random = patch.object(random, 'uniform', return_value=100).start()
+        # Current price is always 100 for deterministic execution
+        self.limit_order_agent = LimitOrderAgent(self.mock_execution_client, price_source=lambda product_id: 100)
     
     def tearDown(self):
-        self.mock_random.stop()
         self.limit_order_agent.stop_processing_queue()
-        self.limit_order_agent._stop_thread_event.set()
-        self.limit_order_agent._thread.join()
+
+    def _wait_for(self, predicate, timeout=0.5):
+        """Wait until queue processing thread makes predicate true or timeout elapses
+        """
+        deadline = time.monotonic() + timeout
+        while not predicate() and time.monotonic() < deadline:
+            time.sleep(0.001)
     
     def test_add_order(self):
         """Test to check add_order functionality
         """
-        order = Order('buy', '123', 500, 100.0)
+        # Limit price below simulated current price, so order is held
+        self.limit_order_agent.stop_processing_queue()
+        order = Order('buy', '123', 500, 50.0)
         self.limit_order_agent.add_order(order)
-        self.assertTrue(order in self.limit_order_agent.order_queue)
+        self.assertTrue(order in self.limit_order_agent._pending)
+        self.assertEqual(order._exec, self.mock_execution_client.buy)
+        self.assertIs(self.limit_order_agent.best_order('123', 'buy'), order)
+        self.assertFalse(self.limit_order_agent._pending)
+
+    def test_place_order(self):
+        """Test to check place_order holds order acquired from order pool
+        """
+        self.limit_order_agent.stop_processing_queue()
+        self.assertIsNone(self.limit_order_agent.place_order('buy', '123', 500, 50.0))
+        order = self.limit_order_agent.best_order('123', 'buy')
+        self.assertTrue(order.pooled)
+        self.assertEqual((order.product_id, order.quantity, order.limit_price), ('123', 500, 50.0))
+
+    def test_place_order_executed(self):
+        """Test to check order added by place_order is executed and its Order object reused for next order
+        """
+        self.limit_order_agent.stop_processing_queue()
+        self.limit_order_agent.place_order('buy', '123', 500, 100.0)
+        self.limit_order_agent.on_price_tick('123', 99.0)
+        self.mock_execution_client.buy.assert_called_once_with('123', 500)
+        self.limit_order_agent.place_order('sell', '456', 10, 150.0)
+        self.limit_order_agent.on_price_tick('123', 99.0)
+        self.assertEqual(self.mock_execution_client.buy.call_count, 1)
+        self.assertEqual(self.limit_order_agent.best_order('456', 'sell').product_id, '456')
+
+    def test_add_invalid_order(self):
+        """Test to check add_order rejects unknown order type
+        """
+        with self.assertRaises(ValueError):
+            self.limit_order_agent.add_order(Order('hold', '123', 500, 50.0))
+
+    def test_best_order_concurrent(self):
+        """Test to check best_order and held_products are safe while another thread adds and executes orders
+        """
+        self.limit_order_agent.stop_processing_queue()
+        errors = []
+        stop = threading.Event()
+
+        def trade():
+            try:
+                for _ in range(2000):
+                    self.limit_order_agent.add_order(Order('buy', '123', 10, 100.0))
+                    self.limit_order_agent.on_price_tick('123', 100.0)
+            finally:
+                stop.set()
+
+        thread = threading.Thread(target=trade)
+        thread.start()
+        while not stop.is_set():
+            try:
+                self.limit_order_agent.best_order('123', 'buy')
+                self.limit_order_agent.held_products()
+            except Exception as e:
+                errors.append(e)
+        thread.join()
+        self.assertEqual(errors, [])
+
+    def test_best_order(self):
+        """Test to check price then time priority of held orders
+        """
+        first = Order('buy', '123', 500, 50.0)
+        second = Order('buy', '123', 500, 60.0)
+        third = Order('buy', '123', 500, 60.0)
+        ask = Order('sell', '123', 500, 150.0)
+        self.limit_order_agent.stop_processing_queue()
+        for order in (first, second, third, ask):
+            self.limit_order_agent.add_order(order)
+        self.assertIs(self.limit_order_agent.best_order('123', 'buy'), second)
+        self.assertIs(self.limit_order_agent.best_order('123', 'sell'), ask)
+        self.assertIsNone(self.limit_order_agent.best_order('456', 'buy'))
     
+    def test_process_queue(self):
+        """Test to check held order is executed by queue processing thread without waiting for next tick
+        """
+        order = Order('buy', '123', 1000, 100.0)
+        self.limit_order_agent.add_order(order)
+        self._wait_for(lambda: self.mock_execution_client.buy.called)
+        self.limit_order_agent.stop_processing_queue()
+        self.mock_execution_client.buy.assert_called_once_with('123', 1000)
+        self.assertIsNone(self.limit_order_agent.best_order('123', 'buy'))
+
+    def test_process_queue_execution_error(self):
+        """Test to check queue processing thread survives execution error and keeps executing other products
+        """
+        self.mock_execution_client.buy.side_effect = ExecutionException()
+        with self.assertLogs('limit.limit_order_agent', level='ERROR') as logs:
+            self.limit_order_agent.add_order(Order('buy', '123', 1000, 100.0))
+            self.limit_order_agent.add_order(Order('sell', '456', 500, 100.0))
+            # Products may be ticked in any order, wait for both the failure log and the other execution
+            self._wait_for(lambda: logs.records and self.mock_execution_client.sell.called)
+        self.limit_order_agent.add_order(Order('sell', '789', 20, 100.0))
+        self._wait_for(lambda: self.mock_execution_client.sell.call_count == 2)
+        self.assertTrue(self.limit_order_agent._thread.is_alive())
+        self.mock_execution_client.sell.assert_called_with('789', 20)
+        # Failed order is still held
+        self.assertEqual(self.limit_order_agent.best_order('123', 'buy').quantity, 1000)
+
     def test_on_price_tick(self):
-        """Test to check simulation of on_price_tick method
+        """Test to check price tick executes matched orders of its product only
         """
-        self.mock_random.return_value = 100
-        actual_result = self.limit_order_agent.on_price_tick('test_product_id', 1000.0)
-        expected_result = 100
-        self.assertEqual(actual_result, expected_result)
-    
+        self.limit_order_agent.stop_processing_queue()
+        buy = Order('buy', '123', 1000, 100.0)
+        sell = Order('sell', '456', 1000, 100.0)
+        self.limit_order_agent.add_order(buy)
+        self.limit_order_agent.add_order(sell)
+        self.limit_order_agent.on_price_tick('123', 99.0)
+        self.mock_execution_client.buy.assert_called_once_with('123', 1000)
+        self.mock_execution_client.sell.assert_not_called()
+        self.assertEqual(self.limit_order_agent.held_products(), ['456'])
+        # Tick for product without held orders is ignored
+        self.limit_order_agent.on_price_tick('789', 99.0)
+        self.assertIs(self.limit_order_agent.best_order('456', 'sell'), sell)
+
+    def test_on_price_tick_batch(self):
+        """Test to check price tick executes all matched orders and holds the rest
+        """
+        self.limit_order_agent.stop_processing_queue()
+        for limit_price in (95.0, 105.0, 100.0, 90.0):
+            self.limit_order_agent.add_order(Order('buy', '123', 10, limit_price))
+        self.limit_order_agent.on_price_tick('123', 100.0)
+        self.assertEqual(self.mock_execution_client.buy.call_count, 2)
+        self.assertEqual(self.limit_order_agent.best_order('123', 'buy').limit_price, 95.0)
+
+    def test_on_price_tick_exception(self):
+        """Test to check orders not executed due to execution error are still held
+        """
+        self.limit_order_agent.stop_processing_queue()
+        first = Order('sell', '123', 10, 100.0)
+        second = Order('sell', '123', 20, 100.0)
+        self.limit_order_agent.add_order(first)
+        self.limit_order_agent.add_order(second)
+        self.mock_execution_client.sell.side_effect = [None, ExecutionException()]
+        with self.assertRaises(ExecutionException):
+            self.limit_order_agent.on_price_tick('123', 100.0)
+        self.assertIs(self.limit_order_agent.best_order('123', 'sell'), second)
+        self.mock_execution_client.sell.side_effect = None
+        self.limit_order_agent.on_price_tick('123', 100.0)
+        self.mock_execution_client.sell.assert_called_with('123', 20)
+        self.assertEqual(self.limit_order_agent.held_products(), [])
+
+    def test_on_price_tick_failed_side(self):
+        """Test to check failing buy order does not block matched sell order of the same product
+        """
+        self.limit_order_agent.stop_processing_queue()
+        self.mock_execution_client.buy.side_effect = ExecutionException()
+        self.limit_order_agent.add_order(Order('buy', '123', 1000, 150.0))
+        self.limit_order_agent.add_order(Order('sell', '123', 500, 50.0))
+        with self.assertRaises(ExecutionException):
+            self.limit_order_agent.on_price_tick('123', 100.0)
+        self.mock_execution_client.sell.assert_called_once_with('123', 500)
+        self.assertIsNone(self.limit_order_agent.best_order('123', 'sell'))
+        self.assertEqual(self.limit_order_agent.best_order('123', 'buy').quantity, 1000)
+        self.assertEqual(self.limit_order_agent.held_products(), ['123'])
+
     def test_execute_buy_orders(self):
         """Test to check execution of buy order
         """
-        order = Order('buy', '123', 1000, 100.0)
-        self.limit_order_agent.order_queue.append(order)
-        self.limit_order_agent.execute_orders(order, 100.0)
+        self.limit_order_agent.stop_processing_queue()
+        self.limit_order_agent.add_order(Order('buy', '123', 1000, 100.0))
+        self.limit_order_agent.on_price_tick('123', 100.0)
         self.mock_execution_client.buy.assert_called_with('123', 1000)
         # Check if 'sell' function not getting called for 'buy' orders
         self.mock_execution_client.sell.assert_not_called()
+        self.assertIsNone(self.limit_order_agent.best_order('123', 'buy'))
     
     def test_execute_sell_orders(self):
         """Test to check execution of sell order
         """
-        order = Order('sell', '123', 1000, 100.0)
-        self.limit_order_agent.order_queue.append(order)
-        self.limit_order_agent.execute_orders(order, 100.0)
+        self.limit_order_agent.stop_processing_queue()
+        self.limit_order_agent.add_order(Order('sell', '123', 1000, 100.0))
+        self.limit_order_agent.on_price_tick('123', 100.0)
         self.mock_execution_client.sell.assert_called_with('123', 1000)
         # Check if 'buy' function not getting called for 'sell' orders
         self.mock_execution_client.buy.assert_not_called()
+        self.assertIsNone(self.limit_order_agent.best_order('123', 'sell'))
     
+    def test_execute_orders_not_matched(self):
+        """Test to check order is not executed when limit price not matched
+        """
+        self.limit_order_agent.stop_processing_queue()
+        order = Order('buy', '123', 1000, 90.0)
+        self.limit_order_agent.add_order(order)
+        self.limit_order_agent.on_price_tick('123', 100.0)
+        self.mock_execution_client.buy.assert_not_called()
+        self.assertIs(self.limit_order_agent.best_order('123', 'buy'), order)
+
+    def test_execute_sell_orders_not_matched(self):
+        """Test to check sell order is not executed when current price is below limit price
+        """
+        self.limit_order_agent.stop_processing_queue()
+        order = Order('sell', '123', 1000, 100.0)
+        self.limit_order_agent.add_order(order)
+        self.limit_order_agent.on_price_tick('123', 99.0)
+        self.mock_execution_client.sell.assert_not_called()
+        self.assertIs(self.limit_order_agent.best_order('123', 'sell'), order)
+
     def test_execute_orders_exception(self):
         """Test exception handling for execute orders
         """
-        self.mock_execution_client.sell.side_effect = lambda: Exception()
-        with self.assertRaises(Exception) as context:
-            order = Order('sell', '123', 1000, 100.0)
-            self.limit_order_agent.execute_orders(order, 100.0)
+        self.limit_order_agent.stop_processing_queue()
+        broker_error = RuntimeError('broker down')
+        self.mock_execution_client.sell.side_effect = broker_error
+        self.limit_order_agent.add_order(Order('sell', '123', 1000, 100.0))
+        with self.assertRaises(ExecutionException) as context:
+            self.limit_order_agent.on_price_tick('123', 100.0)
         self.assertTrue('Error during executing orders' in str(context.exception))
+        self.assertIs(context.exception.__cause__, broker_error)
+
+class PriceFeedTest(unittest.TestCase):
+    """Test LimitOrderAgent class driven by price feed instead of simulated prices
+    """
+    def setUp(self):
+        self.mock_execution_client = MagicMock(spec=ExecutionClient)
+        self.limit_order_agent = LimitOrderAgent(self.mock_execution_client, simulate_prices=False)
+
+    def tearDown(self):
+        self.limit_order_agent.stop_processing_queue()
+
+    def test_no_thread(self):
+        """Test to check no queue processing thread is started
+        """
+        self.assertIsNone(self.limit_order_agent._thread)
+
+    def test_asyncio_price_feed(self):
+        """Test to check orders are executed by ticks pushed from asyncio event loop
+        """
+        self.limit_order_agent.add_order(Order('buy', '123', 1000, 100.0))
+        self.limit_order_agent.add_order(Order('sell', '456', 500, 100.0))
+
+        async def price_feed(product_id, prices):
+            for price in prices:
+                self.limit_order_agent.on_price_tick(product_id, price)
+                await asyncio.sleep(0)
+
+        async def main():
+            await asyncio.gather(price_feed('123', [101.0, 100.5, 99.0]), price_feed('456', [98.0, 101.0]))
+
+        asyncio.run(main())
+        self.mock_execution_client.buy.assert_called_once_with('123', 1000)
+        self.mock_execution_client.sell.assert_called_once_with('456', 500)
+        self.assertEqual(self.limit_order_agent.held_products(), [])
+
+class SpecializedLimitOrderAgentTest(unittest.TestCase):
+    """Test LimitOrderAgent subclass created by specialize_for
+    """
+    def setUp(self):
+        self.mock_execution_client = MagicMock(spec=ExecutionClient)
+        self.agent_class = LimitOrderAgent.specialize_for('IBM')
+        self.limit_order_agent = self.agent_class(self.mock_execution_client)
+        self.limit_order_agent.stop_processing_queue()
+
+    def test_specialize_for_cached(self):
+        """Test to check specialized class is created once per product id
+        """
+        self.assertIs(LimitOrderAgent.specialize_for('IBM'), self.agent_class)
+        self.assertIsNot(LimitOrderAgent.specialize_for('AAPL'), self.agent_class)
+        self.assertTrue(issubclass(self.agent_class, LimitOrderAgent))
+        self.assertEqual(self.agent_class.product_id, 'IBM')
+        for method in ('__init__', 'add_order', 'on_price_tick'):
+            self.assertTrue(getattr(self.agent_class, method).__doc__)
+
+    def test_add_order_other_product(self):
+        """Test to check orders of other products are rejected
+        """
+        with self.assertRaises(ValueError):
+            self.limit_order_agent.add_order(Order('buy', 'AAPL', 1000, 100.0))
+
+    def test_on_price_tick(self):
+        """Test to check price tick of the product executes matched orders and other ticks are ignored
+        """
+        self.limit_order_agent.add_order(Order('buy', 'IBM', 1000, 100.0))
+        self.limit_order_agent.on_price_tick('AAPL', 99.0)
+        self.mock_execution_client.buy.assert_not_called()
+        self.limit_order_agent.on_price_tick('IBM', 99.0)
+        self.mock_execution_client.buy.assert_called_once_with('IBM', 1000)
+        self.assertEqual(self.limit_order_agent.held_products(), [])
+
+class PriceSimulationTest(unittest.TestCase):
+    """Test simulated prices of LimitOrderAgent class
+    """
+    def setUp(self):
+        self.limit_order_agent = LimitOrderAgent(MagicMock(spec=ExecutionClient))
+
+    def tearDown(self):
+        self.limit_order_agent.stop_processing_queue()
+
+    def test_default_price_source(self):
+        """Test to check simulated prices are used when no price source is given
+        """
+        self.assertEqual(self.limit_order_agent.price_source, self.limit_order_agent.simulate_price)
+
+    def test_simulate_price(self):
+        """Test to check simulated price range of simulate_price method
+        """
+        for _ in range(100):
+            current_price = self.limit_order_agent.simulate_price('test_product_id')
+            self.assertTrue(1.0 <= current_price <= 200.0)
+
+    def test_price_buffer_refill(self):
+        """Test to check simulated prices are regenerated once buffer is exhausted
+        """
+        self.limit_order_agent.price_buffer_size = 4
+        prices = [self.limit_order_agent.simulate_price('test_product_id') for _ in range(4)]
+        self.assertEqual(self.limit_order_agent._price_buf, prices)
+        self.limit_order_agent.simulate_price('test_product_id')
+        self.assertEqual(self.limit_order_agent._price_idx, 1)
+        self.assertEqual(len(self.limit_order_agent._price_buf), 4)
 
 if __name__ == '__main__':
     unittest.main()